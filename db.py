@@ -1,10 +1,13 @@
 # db.py
 import os
+import threading
 import psycopg2
-from psycopg2.extras import DictCursor, execute_batch
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import DictCursor, execute_values
 from dotenv import load_dotenv
 import logging
 from decimal import Decimal
+from cachetools import TTLCache
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -14,15 +17,83 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
-    """Устанавливает соединение с базой данных."""
+# Кэш пользовательских данных: ключ (вид данных, telegram_id).
+# Все изменения этих данных проходят через функции модуля, которые сбрасывают нужную запись,
+# поэтому TTL лишь страхует от правок в БД в обход бота.
+USER_CACHE_TTL_SECONDS = 60
+# Функции модуля вызываются и из рабочих потоков (asyncio.to_thread), а TTLCache не потокобезопасен.
+_user_cache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+_user_cache_lock = threading.Lock()
+
+def _get_user_cache(kind: str, telegram_id: int):
+    """Возвращает закэшированные данные пользователя указанного вида или None."""
+    with _user_cache_lock:
+        return _user_cache.get((kind, telegram_id))
+
+def _set_user_cache(kind: str, telegram_id: int, value):
+    """Кэширует данные пользователя указанного вида."""
+    with _user_cache_lock:
+        _user_cache[(kind, telegram_id)] = value
+
+def _copy_products(products: dict) -> dict:
+    """Копия продуктов пользователя вместе с записями, чтобы изменения вызывающего не попали в кэш."""
+    return {key: dict(product) for key, product in products.items()}
+
+def _invalidate_user_cache(kind: str, telegram_id: int):
+    """Сбрасывает закэшированные данные пользователя указанного вида."""
+    with _user_cache_lock:
+        _user_cache.pop((kind, telegram_id), None)
+
+# Пул соединений с БД. Создается в init_pool() при запуске бота; до этого (и в скриптах)
+# каждое обращение открывает свое соединение. Семафор заставляет ждать свободное соединение,
+# а не падать с ошибкой, когда все соединения пула заняты, но не дольше DB_POOL_TIMEOUT_SECONDS:
+# после этого функция ведет себя как при недоступной БД, а не подвешивает вызывающий поток.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "4"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "5"))
+_pool = None
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+
+def init_pool():
+    """Создает пул соединений с базой данных."""
+    global _pool
+    if _pool is not None:
+        return
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn
+        _pool = ThreadedConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DATABASE_URL)
     except psycopg2.OperationalError as e:
+        logger.error(f"Не удалось создать пул соединений с базой данных: {e}")
+
+def get_db_connection():
+    """Берет соединение из пула (или устанавливает новое, если пул не создан)."""
+    if _pool is None:
+        try:
+            return psycopg2.connect(DATABASE_URL)
+        except psycopg2.OperationalError as e:
+            logger.error(f"Ошибка подключения к базе данных: {e}")
+            return None
+
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT_SECONDS):
+        logger.error(f"Нет свободного соединения в пуле за {DB_POOL_TIMEOUT_SECONDS} с.")
+        return None
+    try:
+        return _pool.getconn()
+    except psycopg2.Error as e:
+        _pool_slots.release()
         logger.error(f"Ошибка подключения к базе данных: {e}")
         return None
 
+def release_db_connection(conn):
+    """Возвращает соединение в пул (или закрывает его, если пул не создан)."""
+    if _pool is None:
+        conn.close()
+        return
+    try:
+        # незавершенную транзакцию пул откатит сам, разорванное соединение закроет
+        _pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _pool_slots.release()
+
 # --- Функции для работы с пользователями и их продуктами ---
 
 def ensure_user_exists(telegram_id: int, first_name: str):
@@ -36,10 +107,12 @@ def ensure_user_exists(telegram_id: int, first_name: str):
     """
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id, first_name))
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (telegram_id, first_name))
+        finally:
+            release_db_connection(conn)
 
 def get_user_products(telegram_id: int) -> dict:
     """
@@ -53,22 +126,68 @@ def get_user_products(telegram_id: int) -> dict:
         JOIN users u ON u.id = up.user_id
         WHERE u.telegram_id = %s;
     """
+    cached = _get_user_cache('products', telegram_id)
+    if cached is not None:
+        return _copy_products(cached)
+
     products = {}
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute(sql, (telegram_id,))
-                for row in cur.fetchall():
-                    product_name_db = row['name']
-                    product_key = product_name_db.lower()
-                    products[product_key] = {
-                        'product_id': row['product_id'],
-                        'db_name': product_name_db,
-                        'quantity': row['quantity'],
-                        'unit': row['unit']
-                    }
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute(sql, (telegram_id,))
+                    for row in cur.fetchall():
+                        product_name_db = row['name']
+                        product_key = product_name_db.lower()
+                        products[product_key] = {
+                            'product_id': row['product_id'],
+                            'db_name': product_name_db,
+                            'quantity': row['quantity'],
+                            'unit': row['unit']
+                        }
+        finally:
+            release_db_connection(conn)
+        _set_user_cache('products', telegram_id, products)
+        products = _copy_products(products)
+    return products
+
+def get_user_products_by_ids(telegram_id: int, product_ids: list[int]) -> dict:
+    """
+    Возвращает только указанные продукты из холодильника пользователя, ключ - id продукта.
+    Формат значения как в get_user_products. Если весь холодильник уже в кэше, БД не запрашивается.
+    """
+    sql = """
+        SELECT p.id AS product_id, p.name, up.quantity, up.unit
+        FROM user_products up
+        JOIN products p ON p.id = up.product_id
+        WHERE up.user_id = (SELECT id FROM users WHERE telegram_id = %s)
+        AND up.product_id = ANY(%s);
+    """
+    if not product_ids:
+        return {}
+
+    cached = _get_user_cache('products', telegram_id)
+    if cached is not None:
+        wanted = set(product_ids)
+        return {p['product_id']: dict(p) for p in cached.values() if p['product_id'] in wanted}
+
+    products = {}
+    conn = get_db_connection()
+    if conn:
+        try:
+            with conn:
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute(sql, (telegram_id, list(product_ids)))
+                    for row in cur.fetchall():
+                        products[row['product_id']] = {
+                            'product_id': row['product_id'],
+                            'db_name': row['name'],
+                            'quantity': row['quantity'],
+                            'unit': row['unit']
+                        }
+        finally:
+            release_db_connection(conn)
     return products
 
 def get_user_equipment(telegram_id: int) -> set:
@@ -80,15 +199,22 @@ def get_user_equipment(telegram_id: int) -> set:
         JOIN users u ON u.id = ue.user_id
         WHERE u.telegram_id = %s;
     """
+    cached = _get_user_cache('equipment', telegram_id)
+    if cached is not None:
+        return set(cached)
+
     equipment = set()
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id,))
-                for row in cur.fetchall():
-                    equipment.add(row[0].lower())
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (telegram_id,))
+                    for row in cur.fetchall():
+                        equipment.add(row[0].lower())
+        finally:
+            release_db_connection(conn)
+        _set_user_cache('equipment', telegram_id, frozenset(equipment))
     return equipment
 
 def upsert_products_to_user(telegram_id: int, products_data: list):
@@ -96,41 +222,120 @@ def upsert_products_to_user(telegram_id: int, products_data: list):
     Пакетное добавление/обновление продуктов пользователя.
     products_data - список словарей: [{'product_id': int, 'quantity': Decimal, 'unit': str}]
     """
+    apply_fridge_delta(telegram_id, [], products_data)
+
+def add_products_to_user(telegram_id: int, products_delta: list) -> dict:
+    """
+    Добавляет продукты в холодильник одним запросом: если продукт уже есть и у обоих
+    количеств оно задано, количество суммируется (ед. измерения берется новая, если указана),
+    иначе запись перезаписывается. Продукты в products_delta не должны повторяться.
+    Возвращает {product_id: {'quantity', 'unit', 'old_quantity'}} с итоговыми значениями
+    и количеством до изменения (None, если продукта не было или количество не было задано).
+    """
     sql = """
-        INSERT INTO user_products (user_id, product_id, quantity, unit)
-        VALUES (
-            (SELECT id FROM users WHERE telegram_id = %(telegram_id)s),
-            %(product_id)s,
-            %(quantity)s,
-            %(unit)s
+        WITH delta (user_id, product_id, quantity, unit) AS (
+            VALUES %s
+        ),
+        old AS (
+            SELECT up.product_id, up.quantity
+            FROM user_products up
+            JOIN delta d ON d.user_id = up.user_id AND d.product_id = up.product_id
+        ),
+        upserted AS (
+            INSERT INTO user_products (user_id, product_id, quantity, unit)
+            SELECT user_id, product_id, quantity, unit FROM delta
+            ON CONFLICT (user_id, product_id) DO UPDATE SET
+                quantity = CASE
+                    WHEN user_products.quantity IS NOT NULL AND EXCLUDED.quantity IS NOT NULL
+                    THEN user_products.quantity + EXCLUDED.quantity
+                    ELSE EXCLUDED.quantity
+                END,
+                unit = CASE
+                    WHEN user_products.quantity IS NOT NULL AND EXCLUDED.quantity IS NOT NULL
+                    THEN COALESCE(EXCLUDED.unit, user_products.unit)
+                    ELSE EXCLUDED.unit
+                END
+            RETURNING product_id, quantity, unit
         )
-        ON CONFLICT (user_id, product_id) DO UPDATE SET
-            quantity = EXCLUDED.quantity,
-            unit = EXCLUDED.unit;
+        SELECT upserted.product_id, upserted.quantity, upserted.unit, old.quantity AS old_quantity
+        FROM upserted
+        LEFT JOIN old ON old.product_id = upserted.product_id;
     """
+    template = """(
+        (SELECT id FROM users WHERE telegram_id = %(telegram_id)s),
+        %(product_id)s,
+        %(quantity)s::numeric,
+        %(unit)s::text
+    )"""
+    if not products_delta:
+        return {}
+
+    result = {}
     conn = get_db_connection()
-    if conn and products_data:
-        for p in products_data:
-            p['telegram_id'] = telegram_id
-        
-        with conn:
-            with conn.cursor() as cur:
-                execute_batch(cur, sql, products_data)
-        conn.close()
+    if conn:
+        try:
+            rows = [dict(p, telegram_id=telegram_id) for p in products_delta]
+            with conn:
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    for row in execute_values(cur, sql, rows, template=template, fetch=True):
+                        result[row['product_id']] = {
+                            'quantity': row['quantity'],
+                            'unit': row['unit'],
+                            'old_quantity': row['old_quantity']
+                        }
+        finally:
+            release_db_connection(conn)
+    _invalidate_user_cache('products', telegram_id)
+    return result
 
 def remove_products_from_user(telegram_id: int, product_ids: list[int]):
     """Пакетное удаление продуктов пользователя по списку идентификаторов."""
-    sql = """
+    apply_fridge_delta(telegram_id, product_ids, [])
+
+def apply_fridge_delta(telegram_id: int, product_ids_to_delete: list[int], products_to_upsert: list):
+    """
+    Применяет изменения холодильника одной транзакцией: удаляет продукты по списку
+    идентификаторов одним DELETE и добавляет/обновляет остальные одним многострочным
+    INSERT ... ON CONFLICT (формат как в upsert_products_to_user).
+    """
+    delete_sql = """
         DELETE FROM user_products
         WHERE user_id = (SELECT id FROM users WHERE telegram_id = %s)
         AND product_id = ANY(%s);
     """
+    upsert_sql = """
+        INSERT INTO user_products (user_id, product_id, quantity, unit)
+        VALUES %s
+        ON CONFLICT (user_id, product_id) DO UPDATE SET
+            quantity = EXCLUDED.quantity,
+            unit = EXCLUDED.unit;
+    """
+    upsert_template = """(
+        (SELECT id FROM users WHERE telegram_id = %(telegram_id)s),
+        %(product_id)s,
+        %(quantity)s,
+        %(unit)s
+    )"""
+    if not product_ids_to_delete and not products_to_upsert:
+        return
     conn = get_db_connection()
-    if conn and product_ids:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id, product_ids))
-        conn.close()
+    if conn:
+        try:
+            # В одном INSERT ... ON CONFLICT строка не может обновляться дважды,
+            # поэтому для повторяющегося продукта остается последняя запись
+            upsert_rows = list({p['product_id']: p for p in products_to_upsert}.values())
+            for p in upsert_rows:
+                p['telegram_id'] = telegram_id
+
+            with conn:
+                with conn.cursor() as cur:
+                    if product_ids_to_delete:
+                        cur.execute(delete_sql, (telegram_id, product_ids_to_delete))
+                    if upsert_rows:
+                        execute_values(cur, upsert_sql, upsert_rows, template=upsert_template)
+        finally:
+            release_db_connection(conn)
+    _invalidate_user_cache('products', telegram_id)
 
 def add_user_equipment(telegram_id: int, equipment_names: set):
     """Добавляет оборудование пользователю."""
@@ -142,12 +347,17 @@ def add_user_equipment(telegram_id: int, equipment_names: set):
         FROM equipment e WHERE e.name = ANY(%s)
         ON CONFLICT (user_id, equipment_id) DO NOTHING;
     """
+    if not equipment_names:
+        return
     conn = get_db_connection()
-    if conn and equipment_names:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id, list(equipment_names)))
-        conn.close()
+    if conn:
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (telegram_id, list(equipment_names)))
+        finally:
+            release_db_connection(conn)
+    _invalidate_user_cache('equipment', telegram_id)
 
 def remove_user_equipment(telegram_id: int, equipment_names: set):
     """Удаляет оборудование у пользователя."""
@@ -156,12 +366,17 @@ def remove_user_equipment(telegram_id: int, equipment_names: set):
         WHERE user_id = (SELECT id FROM users WHERE telegram_id = %s)
         AND equipment_id IN (SELECT id FROM equipment WHERE name = ANY(%s));
     """
+    if not equipment_names:
+        return
     conn = get_db_connection()
-    if conn and equipment_names:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id, list(equipment_names)))
-        conn.close()
+    if conn:
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (telegram_id, list(equipment_names)))
+        finally:
+            release_db_connection(conn)
+    _invalidate_user_cache('equipment', telegram_id)
 
 # --- функции для предпочтений и ограничений ---
 
@@ -172,14 +387,21 @@ def get_user_preferences_with_ids(telegram_id: int) -> list[dict]:
         WHERE user_id = (SELECT id FROM users WHERE telegram_id = %s)
         ORDER BY id;
     """
+    cached = _get_user_cache('preferences', telegram_id)
+    if cached is not None:
+        return list(cached)
+
     notes = []
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute(sql, (telegram_id,))
-                notes = cur.fetchall()
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute(sql, (telegram_id,))
+                    notes = cur.fetchall()
+        finally:
+            release_db_connection(conn)
+        _set_user_cache('preferences', telegram_id, tuple(notes))
     return notes
 
 def get_user_food_constraints_with_ids(telegram_id: int) -> list[dict]:
@@ -189,41 +411,126 @@ def get_user_food_constraints_with_ids(telegram_id: int) -> list[dict]:
         WHERE user_id = (SELECT id FROM users WHERE telegram_id = %s)
         ORDER BY id;
     """
+    cached = _get_user_cache('constraints', telegram_id)
+    if cached is not None:
+        return list(cached)
+
     notes = []
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute(sql, (telegram_id,))
-                notes = cur.fetchall()
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute(sql, (telegram_id,))
+                    notes = cur.fetchall()
+        finally:
+            release_db_connection(conn)
+        _set_user_cache('constraints', telegram_id, tuple(notes))
     return notes
 
-def add_user_preference(telegram_id: int, note: str):
-    """Добавляет новое текстовое предпочтение пользователю."""
+def get_user_bundle(telegram_id: int) -> dict:
+    """
+    Возвращает все данные пользователя одним запросом к БД:
+    {'products': ..., 'equipment': ..., 'preferences': ..., 'constraints': ...}
+    в тех же форматах, что и get_user_products, get_user_equipment,
+    get_user_preferences_with_ids и get_user_food_constraints_with_ids.
+    Если все четыре вида уже есть в кэше, БД не запрашивается.
+    """
     sql = """
-        INSERT INTO user_product_preferences (user_id, note)
-        VALUES ((SELECT id FROM users WHERE telegram_id = %s), %s);
+        WITH u AS (SELECT id FROM users WHERE telegram_id = %s)
+        SELECT 'products' AS kind, p.id AS item_id, p.name AS value, up.quantity, up.unit
+        FROM user_products up
+        JOIN products p ON p.id = up.product_id
+        WHERE up.user_id = (SELECT id FROM u)
+        UNION ALL
+        SELECT 'equipment', e.id, e.name, NULL, NULL
+        FROM user_equipment ue
+        JOIN equipment e ON e.id = ue.equipment_id
+        WHERE ue.user_id = (SELECT id FROM u)
+        UNION ALL
+        SELECT 'preferences', id, note, NULL, NULL
+        FROM user_product_preferences
+        WHERE user_id = (SELECT id FROM u)
+        UNION ALL
+        SELECT 'constraints', id, note, NULL, NULL
+        FROM user_food_constraints
+        WHERE user_id = (SELECT id FROM u)
+        ORDER BY kind, item_id;
     """
+    kinds = ('products', 'equipment', 'preferences', 'constraints')
+    cached = {kind: _get_user_cache(kind, telegram_id) for kind in kinds}
+    if all(value is not None for value in cached.values()):
+        return {
+            'products': _copy_products(cached['products']),
+            'equipment': set(cached['equipment']),
+            'preferences': list(cached['preferences']),
+            'constraints': list(cached['constraints']),
+        }
+
+    bundle = {'products': {}, 'equipment': set(), 'preferences': [], 'constraints': []}
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id, note))
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute(sql, (telegram_id,))
+                    for row in cur.fetchall():
+                        kind = row['kind']
+                        if kind == 'products':
+                            bundle['products'][row['value'].lower()] = {
+                                'product_id': row['item_id'],
+                                'db_name': row['value'],
+                                'quantity': row['quantity'],
+                                'unit': row['unit']
+                            }
+                        elif kind == 'equipment':
+                            bundle['equipment'].add(row['value'].lower())
+                        else:
+                            bundle[kind].append({'id': row['item_id'], 'note': row['value']})
+        finally:
+            release_db_connection(conn)
+        _set_user_cache('products', telegram_id, bundle['products'])
+        _set_user_cache('equipment', telegram_id, frozenset(bundle['equipment']))
+        _set_user_cache('preferences', telegram_id, tuple(bundle['preferences']))
+        _set_user_cache('constraints', telegram_id, tuple(bundle['constraints']))
+        bundle['products'] = _copy_products(bundle['products'])
+    return bundle
+
+def add_user_preference(telegram_id: int, note: str):
+    """Добавляет новое текстовое предпочтение пользователю."""
+    add_user_preferences(telegram_id, [note])
+
+def add_user_preferences(telegram_id: int, notes: list[str]):
+    """Добавляет пользователю несколько предпочтений одним многострочным INSERT."""
+    sql = "INSERT INTO user_product_preferences (user_id, note) VALUES %s;"
+    _insert_user_notes(sql, telegram_id, notes)
+    _invalidate_user_cache('preferences', telegram_id)
 
 def add_user_food_constraint(telegram_id: int, note: str):
     """Добавляет новое текстовое ограничение пользователю."""
-    sql = """
-        INSERT INTO user_food_constraints (user_id, note)
-        VALUES ((SELECT id FROM users WHERE telegram_id = %s), %s);
-    """
+    add_user_food_constraints(telegram_id, [note])
+
+def add_user_food_constraints(telegram_id: int, notes: list[str]):
+    """Добавляет пользователю несколько ограничений одним многострочным INSERT."""
+    sql = "INSERT INTO user_food_constraints (user_id, note) VALUES %s;"
+    _insert_user_notes(sql, telegram_id, notes)
+    _invalidate_user_cache('constraints', telegram_id)
+
+def _insert_user_notes(sql: str, telegram_id: int, notes: list[str]):
+    """Вставляет заметки пользователя в одну транзакцию одним запросом (sql с VALUES %s)."""
+    if not notes:
+        return
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id, note))
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    execute_values(
+                        cur, sql, [(telegram_id, note) for note in notes],
+                        template="((SELECT id FROM users WHERE telegram_id = %s), %s)"
+                    )
+        finally:
+            release_db_connection(conn)
 
 def delete_user_preferences_by_ids(telegram_id: int, note_ids: list[int]):
     """Удаляет указанные предпочтения пользователя."""
@@ -235,10 +542,13 @@ def delete_user_preferences_by_ids(telegram_id: int, note_ids: list[int]):
     """
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id, note_ids))
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (telegram_id, note_ids))
+        finally:
+            release_db_connection(conn)
+    _invalidate_user_cache('preferences', telegram_id)
 
 def delete_user_food_constraints_by_ids(telegram_id: int, note_ids: list[int]):
     """Удаляет указанные ограничения пользователя."""
@@ -250,30 +560,39 @@ def delete_user_food_constraints_by_ids(telegram_id: int, note_ids: list[int]):
     """
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id, note_ids))
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (telegram_id, note_ids))
+        finally:
+            release_db_connection(conn)
+    _invalidate_user_cache('constraints', telegram_id)
 
 def clear_user_preferences(telegram_id: int):
     """Удаляет ВСЕ текстовые предпочтения пользователя (для команды "все")."""
     sql = "DELETE FROM user_product_preferences WHERE user_id = (SELECT id FROM users WHERE telegram_id = %s);"
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id,))
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (telegram_id,))
+        finally:
+            release_db_connection(conn)
+    _invalidate_user_cache('preferences', telegram_id)
 
 def clear_user_food_constraints(telegram_id: int):
     """Удаляет ВСЕ текстовые ограничения пользователя (для команды "все")."""
     sql = "DELETE FROM user_food_constraints WHERE user_id = (SELECT id FROM users WHERE telegram_id = %s);"
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (telegram_id,))
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (telegram_id,))
+        finally:
+            release_db_connection(conn)
+    _invalidate_user_cache('constraints', telegram_id)
 
 # --- Функции для работы с рецептами ---
 
@@ -286,53 +605,56 @@ def get_all_recipes() -> list[dict]:
         return []
 
     recipes = {}
-    with conn:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("""
-                SELECT
-                    id,
-                    name,
-                    description,
-                    instructions,
-                    cooking_time_minutes,
-                    equipment_raw AS equipment_raw
-                FROM recipes
-            """)
-            for row in cur.fetchall():
-                recipes[row['id']] = dict(row)
-                recipes[row['id']]['ingredients'] = {}
-                recipes[row['id']]['tags'] = set()
-
-            # 2. ингредиенты
-            cur.execute("""
-                SELECT ri.recipe_id, p.name, ri.quantity_description
-                FROM recipe_ingredients ri
-                JOIN products p ON ri.product_id = p.id
-            """)
-            for row in cur.fetchall():
-                if row['recipe_id'] in recipes:
-                    recipes[row['recipe_id']]['ingredients'][row['name']] = row['quantity_description']
-
-            # 3. теги
-            cur.execute("""
-                SELECT rt.recipe_id, t.name
-                FROM recipe_tags rt
-                JOIN tags t ON rt.tag_id = t.id
-            """)
-            for row in cur.fetchall():
-                if row['recipe_id'] in recipes:
-                    recipes[row['recipe_id']]['tags'].add(row['name'].lower())
+    try:
+        with conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                cur.execute("""
+                    SELECT
+                        id,
+                        name,
+                        description,
+                        instructions,
+                        cooking_time_minutes,
+                        equipment_raw AS equipment_raw
+                    FROM recipes
+                """)
+                for row in cur.fetchall():
+                    recipes[row['id']] = dict(row)
+                    recipes[row['id']]['ingredients'] = {}
+                    recipes[row['id']]['tags'] = set()
+                    recipes[row['id']]['equipment'] = set()
+
+                # 2. ингредиенты
+                cur.execute("""
+                    SELECT ri.recipe_id, p.name, ri.quantity_description
+                    FROM recipe_ingredients ri
+                    JOIN products p ON ri.product_id = p.id
+                """)
+                for row in cur.fetchall():
+                    if row['recipe_id'] in recipes:
+                        recipes[row['recipe_id']]['ingredients'][row['name']] = row['quantity_description']
+
+                # 3. теги
+                cur.execute("""
+                    SELECT rt.recipe_id, t.name
+                    FROM recipe_tags rt
+                    JOIN tags t ON rt.tag_id = t.id
+                """)
+                for row in cur.fetchall():
+                    if row['recipe_id'] in recipes:
+                        recipes[row['recipe_id']]['tags'].add(row['name'].lower())
             
-            # 4. оборудование
-            cur.execute("""
-                SELECT e.name
-                FROM recipe_equipment re
-                JOIN equipment e ON re.equipment_id = e.id
-            """)
-            for row in cur.fetchall():
-                if row['recipe_id'] in recipes:
-                    recipes[row['recipe_id']]['equipment'].add(row['name'].lower())
-    conn.close()
+                # 4. оборудование
+                cur.execute("""
+                    SELECT re.recipe_id, e.name
+                    FROM recipe_equipment re
+                    JOIN equipment e ON re.equipment_id = e.id
+                """)
+                for row in cur.fetchall():
+                    if row['recipe_id'] in recipes:
+                        recipes[row['recipe_id']]['equipment'].add(row['name'].lower())
+    finally:
+        release_db_connection(conn)
     
     return list(recipes.values())
 
@@ -411,7 +733,7 @@ def get_recipe_by_id(recipe_id: int) -> dict | None:
         return recipe
 
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 # --- Функции для получения справочников ---
@@ -458,7 +780,7 @@ def load_products_cache() -> dict:
                             'category_id': row[7]
                         }
         finally:
-            conn.close()
+            release_db_connection(conn)
             
     return products_cache
 
@@ -468,12 +790,14 @@ def get_all_equipment_names() -> set:
     equipment_names = set()
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql)
-                for row in cur.fetchall():
-                    equipment_names.add(row[0].lower())
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql)
+                    for row in cur.fetchall():
+                        equipment_names.add(row[0].lower())
+        finally:
+            release_db_connection(conn)
     return equipment_names
 
 
@@ -481,21 +805,33 @@ def preliminary_filter_recipes_db(
     telegram_id: int,
     recipe_type: str,
     max_time: int = 0,
-) -> list[dict]:
+    catalog: dict[int, dict] | None = None,
+) -> tuple[list[dict], dict[str, dict]]:
     """
     Фильтруем рецепты прямо в Postgres:
     - оставляем только те, что укладываются по времени (если задано)
     - считаем, сколько ингредиентов у пользователя нет
-    - в зависимости от recipe_type отбрасываем лишние
+    - в зависимости от recipe_type отбрасываем лишние (условием HAVING, сразу в запросе)
 
     recipe_type:
         "Только из имеющихся продуктов" -> missing_count = 0
         "Добавить 1-2 недостающих ингредиента" -> missing_count <= 2
+
+    catalog - уже загруженные рецепты {id: рецепт}: ингредиенты, теги и оборудование найденных
+    рецептов берутся из него, и дозапрашиваются из БД только для рецептов, которых там нет.
+
+    Возвращает кортеж: (список рецептов, словарь {название рецепта: рецепт}).
     """
     conn = get_db_connection()
     if not conn:
-        return []
+        return [], {}
 
+    if recipe_type == "✅ Только из имеющихся продуктов":
+        max_missing = 0
+    elif recipe_type == "🛒 Добавить 1-2 недостающих ингредиента":
+        max_missing = 2
+    else:
+        max_missing = None
 
     sql = """
     WITH user_inv AS (
@@ -543,39 +879,41 @@ def preliminary_filter_recipes_db(
         COUNT(*) FILTER (WHERE NOT user_has) AS missing_count
     FROM joined
     GROUP BY recipe_id
+    HAVING (%s IS NULL OR COUNT(*) FILTER (WHERE NOT user_has) <= %s)
     ORDER BY recipe_id;
     """
 
     filtered_recipes = []
     try:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(sql, (telegram_id, max_time, max_time))
-            rows = cur.fetchall()
-
-            only_owned = (recipe_type == "✅ Только из имеющихся продуктов")
-            allow_1_2 = (recipe_type == "🛒 Добавить 1-2 недостающих ингредиента")
-
-            for row in rows:
-                missing = row["missing_count"] or 0
-                if only_owned and missing != 0:
-                    continue
-                if allow_1_2 and missing > 2:
-                    continue
-                
-                filtered_recipes.append(dict(row))
+            cur.execute(sql, (telegram_id, max_time, max_time, max_missing, max_missing))
+            filtered_recipes = [dict(row) for row in cur.fetchall()]
             
             if not filtered_recipes:
-                return []
+                return [], {}
             
-            recipes_map = {recipe['recipe_id']: recipe for recipe in filtered_recipes}
-            recipe_ids = list(recipes_map.keys())
-
-            for recipe in recipes_map.values():
-                recipe['ingredients'] = {}
-                recipe['tags'] = set()
-                recipe['equipment'] = set()
-                recipe['id'] = recipe.pop('recipe_id')
-
+            catalog = catalog or {}
+            recipes_map = {}
+            recipe_ids = []
+            recipes_by_name = {}
+            for row in filtered_recipes:
+                recipe_id = row.pop('recipe_id')
+                known = catalog.get(recipe_id)
+                if known is not None:
+                    # рецепт из каталога разделяет с ним словари и множества, поэтому их нельзя менять
+                    recipe = dict(known, missing_count=row['missing_count'])
+                else:
+                    recipe = row
+                    recipe['ingredients'] = {}
+                    recipe['tags'] = set()
+                    recipe['equipment'] = set()
+                    recipe['id'] = recipe_id
+                    recipe_ids.append(recipe_id)
+                recipes_map[recipe_id] = recipe
+                recipes_by_name[recipe['name']] = recipe
+
+            if not recipe_ids:
+                return list(recipes_map.values()), recipes_by_name
 
             cur.execute(
                 """
@@ -613,12 +951,12 @@ def preliminary_filter_recipes_db(
             for row in cur.fetchall():
                 recipes_map[row['recipe_id']]['equipment'].add(row['name'].lower())
 
-            return list(recipes_map.values())
+            return list(recipes_map.values()), recipes_by_name
 
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-    return [] # На случай, если что-то пошло не так
+    return [], {} # На случай, если что-то пошло не так
 
 def get_recipe_main_image(recipe_id: int) -> str | None:
     """Возвращает URL главного изображения рецепта."""
@@ -626,13 +964,15 @@ def get_recipe_main_image(recipe_id: int) -> str | None:
     image_url = None
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (recipe_id,))
-                result = cur.fetchone()
-                if result:
-                    image_url = result[0]
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (recipe_id,))
+                    result = cur.fetchone()
+                    if result:
+                        image_url = result[0]
+        finally:
+            release_db_connection(conn)
     return image_url
 
 def get_recipe_step_images(recipe_id: int) -> list[dict]:
@@ -646,11 +986,13 @@ def get_recipe_step_images(recipe_id: int) -> list[dict]:
     images = []
     conn = get_db_connection()
     if conn:
-        with conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute(sql, (recipe_id,))
-                images = [dict(row) for row in cur.fetchall()]
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute(sql, (recipe_id,))
+                    images = [dict(row) for row in cur.fetchall()]
+        finally:
+            release_db_connection(conn)
     return images
 
 def get_recipe_nutrition(recipe_id: int) -> dict | None:
@@ -672,21 +1014,54 @@ def get_recipe_nutrition(recipe_id: int) -> dict | None:
         return None
 
     nutrition_info = None
-    with conn:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(sql, (recipe_id,))
-            record = cur.fetchone()
-            if record:
-                nutrition_info = {
-                    'calories': record['calories'] or Decimal('0.00'),
-                    'protein': record['protein'] or Decimal('0.00'),
-                    'fat': record['fat'] or Decimal('0.00'),
-                    'carbs': record['carbs'] or Decimal('0.00'),
-                    'nutrition_missing': record['nutrition_missing'] or 0
-                }
-    conn.close()
+    try:
+        with conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                cur.execute(sql, (recipe_id,))
+                record = cur.fetchone()
+                if record:
+                    nutrition_info = _nutrition_from_row(record)
+    finally:
+        release_db_connection(conn)
     return nutrition_info
 
+def _nutrition_from_row(record) -> dict:
+    """Собирает КБЖУ рецепта из строки таблицы recipes, заменяя пустые значения нулями."""
+    return {
+        'calories': record['calories'] or Decimal('0.00'),
+        'protein': record['protein'] or Decimal('0.00'),
+        'fat': record['fat'] or Decimal('0.00'),
+        'carbs': record['carbs'] or Decimal('0.00'),
+        'nutrition_missing': record['nutrition_missing'] or 0
+    }
+
+def get_recipes_card_data(recipe_ids: list[int]) -> dict[int, tuple]:
+    """
+    Одним запросом возвращает для нескольких рецептов данные карточки, которые иначе
+    запрашиваются по одному через get_recipe_main_image и get_recipe_nutrition:
+    {recipe_id: (url главного изображения, КБЖУ)}.
+    """
+    sql = """
+        SELECT id, image_url, calories, protein, fat, carbs, nutrition_missing
+        FROM recipes
+        WHERE id = ANY(%s);
+    """
+    if not recipe_ids:
+        return {}
+
+    cards = {}
+    conn = get_db_connection()
+    if conn:
+        try:
+            with conn:
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute(sql, (list(recipe_ids),))
+                    for record in cur.fetchall():
+                        cards[record['id']] = (record['image_url'], _nutrition_from_row(record))
+        finally:
+            release_db_connection(conn)
+    return cards
+
 
 def get_product_lifetime(category_id: int):
     sql_categories = f"""
@@ -706,7 +1081,7 @@ def get_product_lifetime(category_id: int):
         except Exception as e:
             logger.error(f"Error getting product category: {e}")
         finally:
-            conn.close()
+            release_db_connection(conn)
 
     return life_time
 
@@ -735,7 +1110,7 @@ def get_product_added_at(telegram_id: int, product_id: int):
         except Exception as e:
             logger.error(f"Error getting product added_at: {e}")
         finally:
-            conn.close()
+            release_db_connection(conn)
 
     return added_at
 
@@ -759,6 +1134,6 @@ def get_product_category(product_id: int):
         except Exception as e:
             logger.error(f"Error getting product category: {e}")
         finally:
-            conn.close()
+            release_db_connection(conn)
 
     return int(category) if category is not None else None
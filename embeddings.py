@@ -0,0 +1,112 @@
+# embeddings.py
+import os
+import logging
+import functools
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+# Семантическое ранжирование необязательно: без sentence-transformers рецепты уходят в LLM как раньше
+try:
+    from sentence_transformers import SentenceTransformer
+    EMBEDDINGS_AVAILABLE = True
+except ImportError:
+    EMBEDDINGS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Глобальная переменная для модели эмбеддингов
+EMBEDDING_MODEL = None
+
+# Индекс рецептов: векторы в int8 (по строке на рецепт) и масштаб каждого вектора
+RECIPE_EMB_Q8: Optional[np.ndarray] = None
+RECIPE_EMB_SCALE: Optional[np.ndarray] = None
+RECIPE_ROW = {}
+
+def init_embedding_model() -> bool:
+    """Загружает модель эмбеддингов, если она указана в EMBEDDING_MODEL."""
+    global EMBEDDING_MODEL
+
+    if EMBEDDING_MODEL is not None:
+        return True
+
+    model_name = os.getenv("EMBEDDING_MODEL")
+    if not model_name:
+        return False
+    if not EMBEDDINGS_AVAILABLE:
+        logger.warning("EMBEDDING_MODEL задана, но пакет sentence-transformers не установлен.")
+        return False
+
+    try:
+        EMBEDDING_MODEL = SentenceTransformer(model_name)
+        logger.info(f"Модель эмбеддингов загружена: {model_name}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке модели эмбеддингов: {e}")
+        return False
+
+def _quantize(vectors: np.ndarray):
+    """
+    Квантует нормированные векторы в int8 с отдельным масштабом на каждый вектор.
+    Возвращает (векторы int8, масштабы float32), где исходный вектор ~ q8 / scale.
+    """
+    max_abs = np.abs(vectors).max(axis=1, keepdims=True)
+    scale = 127.0 / np.maximum(max_abs, 1e-12)
+    q8 = np.round(vectors * scale).astype(np.int8)
+    return q8, scale.reshape(-1).astype(np.float32)
+
+def _recipe_text(recipe: dict) -> str:
+    """Текст рецепта для эмбеддинга: название, ингредиенты и теги."""
+    return ". ".join([
+        recipe['name'],
+        ", ".join(recipe.get('ingredients', {})),
+        ", ".join(recipe.get('tags', ())),
+    ])
+
+def build_recipe_index(recipes: Iterable[dict]) -> None:
+    """Один раз при запуске считает и квантует эмбеддинги всех рецептов каталога."""
+    global RECIPE_EMB_Q8, RECIPE_EMB_SCALE, RECIPE_ROW
+
+    if EMBEDDING_MODEL is None:
+        return
+
+    recipes = list(recipes)
+    if not recipes:
+        return
+
+    vectors = EMBEDDING_MODEL.encode(
+        [_recipe_text(recipe) for recipe in recipes],
+        batch_size=64,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+    )
+    RECIPE_EMB_Q8, RECIPE_EMB_SCALE = _quantize(vectors)
+    RECIPE_ROW = {recipe['id']: row for row, recipe in enumerate(recipes)}
+    _embed_query.cache_clear()
+    logger.info(f"Построен индекс эмбеддингов для {len(recipes)} рецептов.")
+
+@functools.lru_cache(maxsize=1024)
+def _embed_query(query: str) -> np.ndarray:
+    vector = EMBEDDING_MODEL.encode([query], normalize_embeddings=True, convert_to_numpy=True)
+    q8, _ = _quantize(vector)
+    return q8[0].astype(np.int32)
+
+def semantic_scores(recipe_ids: List[int], query: str) -> Optional[np.ndarray]:
+    """
+    Возвращает близость рецептов к запросу пользователя (чем больше, тем ближе)
+    или None, если индекс не построен. Рецептам вне индекса достается наименьшая оценка.
+    """
+    if RECIPE_EMB_Q8 is None or not query:
+        return None
+
+    rows = np.fromiter((RECIPE_ROW.get(recipe_id, -1) for recipe_id in recipe_ids), dtype=np.int64, count=len(recipe_ids))
+    known = rows >= 0
+
+    scores = np.full(len(recipe_ids), -np.inf, dtype=np.float32)
+    if known.any():
+        known_rows = rows[known]
+        # скалярное произведение в целых числах, затем поправка на масштаб каждого рецепта;
+        # масштаб запроса одинаков для всех рецептов и на порядок не влияет
+        dots = RECIPE_EMB_Q8[known_rows].astype(np.int32) @ _embed_query(query)
+        scores[known] = dots / RECIPE_EMB_SCALE[known_rows]
+    return scores
@@ -34,4 +34,7 @@ CONVERSION_FACTORS = {
 EQUIPMENT_LIST = [
     "форма", "блендер", "миксер", "духовка", "мультиварка",
     "пароварка", "гриль", "кухонный комбайн", "скалка", "микроволновка"
-]
\ No newline at end of file
+]
+
+# Бит каждого предмета оборудования: выбор пользователя хранится как битовая маска
+EQUIPMENT_BIT = {equipment: 1 << i for i, equipment in enumerate(EQUIPMENT_LIST)}
\ No newline at end of file
@@ -0,0 +1,197 @@
+# voice.py
+import asyncio
+import concurrent.futures
+import io
+import os
+import orjson
+import logging
+
+from telegram import Update
+from telegram.constants import ChatAction
+from telegram.ext import ContextTypes
+from vosk import Model, KaldiRecognizer
+from pydub import AudioSegment
+
+# Декодирование через libav внутри процесса, без запуска ffmpeg; если PyAV нет - используем pydub
+try:
+    import av
+    PYAV_AVAILABLE = True
+except ImportError:
+    PYAV_AVAILABLE = False
+
+# Детектор речи для пропуска тишины перед распознаванием; без него в Vosk уходит все аудио
+try:
+    import webrtcvad
+    VAD_AVAILABLE = True
+except ImportError:
+    VAD_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Глобальная переменная для модели Vosk
+VOSK_MODEL = None
+# Частота дискретизации, с которой работает модель Vosk
+VOSK_SAMPLE_RATE = 16000
+# Пул потоков для декодирования и распознавания: Vosk и декодеры отпускают GIL,
+# поэтому голосовые сообщения разных пользователей обрабатываются параллельно, не блокируя event loop
+VOSK_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="vosk")
+
+# Сколько кадров передается в Kaldi за один вызов: 8000 кадров - полсекунды аудио
+VOSK_CHUNK_FRAMES = 8000
+
+# Параметры VAD: длина кадра, сколько кадров до речи сохранять (чтобы не обрезать начало слова),
+# сколько тишины оставлять после речи (паузы между словами) и агрессивность детектора (0-3)
+VAD_FRAME_MS = 20
+VAD_FRAME_BYTES = VOSK_SAMPLE_RATE * VAD_FRAME_MS // 1000 * 2
+VAD_PRE_ROLL_FRAMES = 5
+VAD_HANGOVER_FRAMES = 15
+VAD_AGGRESSIVENESS = 2
+
+def init_vosk_model():
+    global VOSK_MODEL
+    
+    if VOSK_MODEL is not None:
+        return True
+    
+    model_path = os.getenv("VOSK_MODEL_PATH", "vosk-model-small-ru-0.22")
+    
+    try:
+        VOSK_MODEL = Model(model_path)
+        logger.info(f"Модель загружена из {model_path}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке модели: {e}")
+        return False
+
+def warm_up_vosk_model() -> None:
+    """
+    Прогоняет через распознаватель секунду тишины, чтобы страницы модели
+    были загружены в память до первого настоящего голосового сообщения.
+    """
+    if VOSK_MODEL is None:
+        return
+    recognize_speech(bytes(VOSK_SAMPLE_RATE * 2))
+
+async def download_voice_file(voice_file, bot) -> bytes:
+    """Скачивает голосовое сообщение в память."""
+    file = await bot.get_file(voice_file.file_id)
+    return bytes(await file.download_as_bytearray())
+
+def _decode_with_pyav(ogg_data: bytes) -> bytes:
+    """
+    Декодирует голосовое сообщение (Opus в OGG) в 16-битный моно PCM
+    с частотой VOSK_SAMPLE_RATE средствами libav, без внешнего процесса ffmpeg.
+    """
+    resampler = av.AudioResampler(format='s16', layout='mono', rate=VOSK_SAMPLE_RATE)
+    chunks = []
+    with av.open(io.BytesIO(ogg_data)) as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().tobytes())
+    # досылаем то, что осталось в буфере ресемплера
+    for resampled in resampler.resample(None):
+        chunks.append(resampled.to_ndarray().tobytes())
+    return b"".join(chunks)
+
+def convert_ogg_to_pcm(ogg_data: bytes) -> bytes:
+    """
+    Декодирует голосовое сообщение в 16-битный моно PCM с частотой VOSK_SAMPLE_RATE
+    прямо в памяти, без временных файлов.
+    """
+    if PYAV_AVAILABLE:
+        try:
+            return _decode_with_pyav(ogg_data)
+        except Exception as e:
+            logger.warning(f"Не удалось декодировать голосовое сообщение через PyAV, используем pydub: {e}")
+
+    audio = AudioSegment.from_file(io.BytesIO(ogg_data), format="ogg")
+    audio = audio.set_frame_rate(VOSK_SAMPLE_RATE).set_channels(1).set_sample_width(2)
+    return audio.raw_data
+
+def _trim_silence(pcm: bytes) -> bytes:
+    """
+    Убирает из PCM длинные участки тишины, оставляя вокруг речи VAD_PRE_ROLL_FRAMES кадров до
+    и VAD_HANGOVER_FRAMES кадров после. Если детектор не нашел речи, аудио возвращается целиком:
+    пусть решает Vosk.
+    """
+    if not VAD_AVAILABLE:
+        return pcm
+
+    vad = webrtcvad.Vad(VAD_AGGRESSIVENESS)
+    frames_count = len(pcm) // VAD_FRAME_BYTES
+    keep = [False] * frames_count
+    last_speech = None
+    for index in range(frames_count):
+        frame = pcm[index * VAD_FRAME_BYTES : (index + 1) * VAD_FRAME_BYTES]
+        if vad.is_speech(frame, VOSK_SAMPLE_RATE):
+            for pre_index in range(max(0, index - VAD_PRE_ROLL_FRAMES), index + 1):
+                keep[pre_index] = True
+            last_speech = index
+        elif last_speech is not None and index - last_speech <= VAD_HANGOVER_FRAMES:
+            keep[index] = True
+
+    if last_speech is None:
+        return pcm
+
+    trimmed = b"".join(
+        pcm[index * VAD_FRAME_BYTES : (index + 1) * VAD_FRAME_BYTES]
+        for index in range(frames_count) if keep[index]
+    )
+    logger.debug(f"VAD: оставлено {len(trimmed)} из {len(pcm)} байт аудио")
+    return trimmed
+
+def recognize_speech(pcm: bytes) -> str:
+    """Распознает речь в 16-битном моно PCM с частотой VOSK_SAMPLE_RATE."""
+    try:
+        pcm = _trim_silence(pcm)
+        rec = KaldiRecognizer(VOSK_MODEL, VOSK_SAMPLE_RATE)
+        rec.SetWords(True)
+        
+        text_parts = []
+        chunk_size = VOSK_CHUNK_FRAMES * 2
+        for offset in range(0, len(pcm), chunk_size):
+            if rec.AcceptWaveform(pcm[offset : offset + chunk_size]):
+                result = orjson.loads(rec.Result())
+                if 'text' in result and result['text']:
+                    text_parts.append(result['text'])
+        
+        final_result = orjson.loads(rec.FinalResult())
+        if 'text' in final_result and final_result['text']:
+            text_parts.append(final_result['text'])
+        
+        recognized_text = ' '.join(text_parts).strip()
+        return recognized_text if recognized_text else None
+        
+    except Exception as e:
+        logger.error(f"Ошибка при распознавании речи: {e}")
+        return None
+
+async def process_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    voice = update.message.voice
+    if not voice:
+        return None
+    
+    try:
+        # индикатор "печатает" показывается, пока идет скачивание и распознавание;
+        # ошибка его отправки не должна мешать распознаванию
+        ogg_data, _ = await asyncio.gather(
+            download_voice_file(voice, context.bot),
+            update.message.chat.send_action(ChatAction.TYPING),
+            return_exceptions=True
+        )
+        if isinstance(ogg_data, BaseException):
+            raise ogg_data
+        loop = asyncio.get_running_loop()
+        pcm = await loop.run_in_executor(VOSK_EXECUTOR, convert_ogg_to_pcm, ogg_data)
+        text = await loop.run_in_executor(VOSK_EXECUTOR, recognize_speech, pcm)
+        
+        if text:
+            logger.info(f"Распознано из голосового сообщения: {text}")
+            return text
+        else:
+            await update.message.reply_text("😕 Не удалось распознать речь. Попробуй еще раз или введи текст.")
+            return None
+            
+    except Exception as e:
+        await update.message.reply_text("😥 Произошла ошибка при обработке голосового сообщения. Попробуй ввести текст.")
+        return None